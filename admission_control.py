@@ -0,0 +1,169 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import jsonify, request
+from werkzeug.exceptions import HTTPException
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_rate, now):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def wait_time(self, cost, now):
+        """
+        Returns 0 when cost can be charged, otherwise number of seconds after which it could be.
+        Cost larger than capacity only needs full bucket, so it's admissible eventually.
+        """
+        self.refill(now)
+        required = min(cost, self.capacity)
+        if self.tokens >= required:
+            return 0
+        return (required - self.tokens) / self.refill_rate
+
+    def try_charge(self, cost, now):
+        """
+        Charges whole cost even above capacity, such debt has to be paid off before next request.
+        """
+        wait = self.wait_time(cost, now)
+        if wait == 0:
+            self.tokens -= cost
+        return wait
+
+
+class AdmissionController:
+    """
+    Charges every request its estimated number of Elasticsearch operations before it runs.
+    Reads and writes get separate concurrency pools, so write bursts can't take all workers,
+    and each client has its own cost budget in each pool. Requests over limits are shed with 429,
+    requests that could never fit in budget with 413.
+    """
+
+    def __init__(self, read_concurrency=32, write_concurrency=4, pool_wait=0.05,
+                 client_budget=2000, client_refill_rate=200, max_buckets=10000):
+        self.pools = {
+            "read": threading.BoundedSemaphore(read_concurrency),
+            "write": threading.BoundedSemaphore(write_concurrency),
+        }
+        self.pool_wait = pool_wait
+        self.client_budget = client_budget
+        self.client_refill_rate = client_refill_rate
+        self.max_buckets = max_buckets
+        # Least recently used bucket first
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        # Costs are the ones charged to client, shed requests count cost known when they were shed
+        self.metrics = {pool: {
+            "admitted": 0,
+            "admitted_cost": 0,
+            "shed_over_budget": 0,
+            "shed_too_large": 0,
+            "shed_pool_full": 0,
+            "shed_cost": 0,
+            "in_flight": 0,
+        } for pool in self.pools}
+
+    def admit(self, pool, cost=lambda: 1, fanout=lambda: 0):
+        """
+        cost returns operations known from request itself and is limited to client_budget,
+        it should raise for malformed requests, which are then rejected with 400.
+        fanout returns operations on documents stored in Elasticsearch, it's called only
+        when client has pool slot and budget for known cost, so it can look them up.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                try:
+                    known_cost = max(1, int(cost()))
+                except Exception:
+                    # Cost that can't be estimated can't be charged, handler could still run part of it
+                    return jsonify({"error": "Malformed request"}), 400
+
+                if known_cost > self.client_budget:
+                    self.shed(pool, "shed_too_large", known_cost)
+                    response = jsonify({
+                        "error": "Request too expensive",
+                        "estimatedCost": known_cost,
+                        "maxCost": self.client_budget
+                    })
+                    return response, 413
+
+                if not self.pools[pool].acquire(timeout=self.pool_wait):
+                    self.shed(pool, "shed_pool_full", known_cost)
+                    return self.too_many_requests(1)
+                try:
+                    client = request.remote_addr
+                    rejection = self.charge(pool, client, known_cost, dry_run=True)
+                    if rejection is not None:
+                        return rejection
+
+                    try:
+                        estimated_cost = known_cost + max(0, int(fanout()))
+                    except HTTPException:
+                        raise
+                    except Exception:
+                        return jsonify({"error": "Cost estimate unavailable"}), 503
+
+                    rejection = self.charge(pool, client, estimated_cost)
+                    if rejection is not None:
+                        return rejection
+                    with self.lock:
+                        self.metrics[pool]["admitted"] += 1
+                        self.metrics[pool]["admitted_cost"] += estimated_cost
+                        self.metrics[pool]["in_flight"] += 1
+                    try:
+                        return view(*args, **kwargs)
+                    finally:
+                        with self.lock:
+                            self.metrics[pool]["in_flight"] -= 1
+                finally:
+                    self.pools[pool].release()
+            return wrapper
+        return decorator
+
+    def charge(self, pool, client, cost, dry_run=False):
+        now = time.monotonic()
+        with self.lock:
+            key = (client, pool)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_buckets:
+                    self.buckets.popitem(last=False)
+                bucket = self.buckets[key] = TokenBucket(self.client_budget, self.client_refill_rate, now)
+            else:
+                self.buckets.move_to_end(key)
+            if dry_run:
+                wait = bucket.wait_time(cost, now)
+            else:
+                wait = bucket.try_charge(cost, now)
+
+        if wait > 0:
+            self.shed(pool, "shed_over_budget", cost)
+            return self.too_many_requests(wait)
+        return None
+
+    def shed(self, pool, reason, cost):
+        with self.lock:
+            self.metrics[pool][reason] += 1
+            self.metrics[pool]["shed_cost"] += cost
+
+    def too_many_requests(self, retry_after):
+        response = jsonify({"error": "Too many requests"})
+        response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+        return response, 429
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "pools": {pool: dict(values) for pool, values in self.metrics.items()},
+                "buckets": len(self.buckets)
+            }
@@ -1,11 +1,105 @@
+import math
 from flask import Flask, jsonify, abort, request
+from elasticsearch import NotFoundError
 from extended_elasticsearch_client import ElasticClient
+from admission_control import AdmissionController
 app = Flask(__name__)
 es = ElasticClient()
+admission = AdmissionController()
+
+# helpers.reindex scrolls and bulk indexes documents in chunks of this size
+REINDEX_CHUNK_SIZE = 500
+
+
+# ------ Cost estimates (Elasticsearch operations per request) ------
+def liked_list(value):
+    if not isinstance(value, list):
+        raise ValueError("Expected list of ids, got {}".format(type(value).__name__))
+    return [int(e) for e in value]
+
+
+def stored_liked_count(ids, index, doc_type, field):
+    """
+    Total length of liked lists stored in documents, handlers fetch and index every document on them.
+    """
+    try:
+        counts = es.get_liked_counts(ids, index, doc_type, field)
+    except NotFoundError:
+        abort(404)
+    if None in counts:
+        # Handler would fail on missing document, possibly after processing previous ones
+        abort(404)
+    return sum(counts)
+
+
+def document_add_cost():
+    # Index document, then get and index every counterpart
+    return 1 + 2 * len(liked_list(request.json))
+
+
+def document_update_cost():
+    liked_list(request.json)
+    return 1
+
+
+def document_delete_cost():
+    # Document id is the only view argument
+    for id in request.view_args.values():
+        int(id)
+    return 2
+
+
+def user_delete_fanout():
+    user_index = request.args.get('user_index', default='users')
+    return 2 * stored_liked_count([request.view_args['user_id']], user_index, 'user', 'ratings')
+
+
+def movie_delete_fanout():
+    movie_index = request.args.get('movie_index', default='movies')
+    return 2 * stored_liked_count([request.view_args['movie_id']], movie_index, 'movie', 'whoRated')
+
+
+def bulk_cost(id_key, list_key):
+    # Get and index document, then get and index every counterpart liked now.
+    # Every item is validated here, handler would fail on it only after processing all previous items
+    cost = 0
+    for e in request.json:
+        int(e[id_key])
+        cost += 2 + 2 * len(liked_list(e[list_key]))
+    return cost
+
+
+def user_bulk_fanout():
+    # Every counterpart liked before update is fetched and indexed too
+    user_index = request.args.get('user_index', default='users')
+    ids = [e["user_id"] for e in request.json]
+    return 2 * stored_liked_count(ids, user_index, 'user', 'ratings')
+
+
+def movie_bulk_fanout():
+    movie_index = request.args.get('movie_index', default='movies')
+    ids = [e["movie_id"] for e in request.json]
+    return 2 * stored_liked_count(ids, movie_index, 'movie', 'whoRated')
+
+
+def reindex_cost():
+    if not isinstance(request.json["source"], str) or not isinstance(request.json["dest"], str):
+        raise ValueError("Expected index names")
+    return 1
+
+
+def reindex_fanout():
+    # One scroll and one bulk request per chunk of source documents
+    try:
+        documents = es.count_documents(request.json["source"])
+    except NotFoundError:
+        abort(404)
+    return 2 * math.ceil(documents / REINDEX_CHUNK_SIZE)
 
 
 # ------ Simple operations ------
 @app.route("/user/document/<id>", methods=["GET"])
+@admission.admit('read')
 def get_user(id):
     try:
         index = request.args.get('user_index', default='users')
@@ -16,6 +110,7 @@ def get_user(id):
 
 
 @app.route("/movie/document/<id>", methods=["GET"])
+@admission.admit('read')
 def get_movie(id):
     try:
         index = request.args.get('movie_index', default='movies')
@@ -27,6 +122,7 @@ def get_movie(id):
 
 # ------ Preselection ------
 @app.route("/user/preselection/<id>", methods=["GET"])
+@admission.admit('read', cost=lambda: 2)
 def user_preselection(id):
     try:
         index = request.args.get('user_index', default='users')
@@ -40,6 +136,7 @@ def user_preselection(id):
 
 
 @app.route("/movie/preselection/<id>", methods=["GET"])
+@admission.admit('read', cost=lambda: 2)
 def movies_preselection(id):
     try:
         index = request.args.get('movie_index', default='movies')
@@ -54,6 +151,7 @@ def movies_preselection(id):
 
 # ------ Add/Update/Delete ------
 @app.route("/user/document/<user_id>", methods=["PUT"])
+@admission.admit('write', cost=document_add_cost)
 def add_user_document(user_id):
     try:
         user_index = request.args.get('user_index', default='users')
@@ -66,6 +164,7 @@ def add_user_document(user_id):
 
 
 @app.route("/movie/document/<movie_id>", methods=["PUT"])
+@admission.admit('write', cost=document_add_cost)
 def add_movie_document(movie_id):
     try:
         user_index = request.args.get('user_index', default='users')
@@ -78,6 +177,7 @@ def add_movie_document(movie_id):
 
 
 @app.route("/user/document/<user_id>", methods=["POST"])
+@admission.admit('write', cost=document_update_cost)
 def update_user_document(user_id):
     try:
         user_index = request.args.get('user_index', default='users')
@@ -90,6 +190,7 @@ def update_user_document(user_id):
 
 
 @app.route("/movie/document/<movie_id>", methods=["POST"])
+@admission.admit('write', cost=document_update_cost)
 def update_movie_document(movie_id):
     try:
         user_index = request.args.get('user_index', default='users')
@@ -102,6 +203,7 @@ def update_movie_document(movie_id):
 
 
 @app.route("/user/document/<user_id>", methods=["DELETE"])
+@admission.admit('write', cost=document_delete_cost, fanout=user_delete_fanout)
 def delete_user_document(user_id):
     try:
         user_index = request.args.get('user_index', default='users')
@@ -113,6 +215,7 @@ def delete_user_document(user_id):
 
 
 @app.route("/movie/document/<movie_id>", methods=["DELETE"])
+@admission.admit('write', cost=document_delete_cost, fanout=movie_delete_fanout)
 def delete_movie_document(movie_id):
     try:
         user_index = request.args.get('user_index', default='users')
@@ -124,6 +227,7 @@ def delete_movie_document(movie_id):
 
 
 @app.route("/user/bulk", methods=["POST"])
+@admission.admit('write', cost=lambda: bulk_cost('user_id', 'liked_movies'), fanout=user_bulk_fanout)
 def bulk_update_users():
     """
     Body should look like this: [{"user_id": 123, "liked_movies": [1,2,3,4]}, ...]
@@ -136,6 +240,7 @@ def bulk_update_users():
 
 
 @app.route("/movie/bulk", methods=["POST"])
+@admission.admit('write', cost=lambda: bulk_cost('movie_id', 'users_who_liked_movie'), fanout=movie_bulk_fanout)
 def bulk_update_movies():
     """
     Body should look like this: [{"movie_id": 123, "users_who_liked_movie": [1,2,3,4]}, ...]
@@ -148,6 +253,7 @@ def bulk_update_movies():
 
 
 @app.route("/indices/<index_name>", methods=["PUT"])
+@admission.admit('write', cost=lambda: 1)
 def create_index(index_name):
     try:
         es.create_index(str(index_name))
@@ -157,6 +263,7 @@ def create_index(index_name):
 
 
 @app.route("/indices", methods=["GET"])
+@admission.admit('read')
 def get_indexes():
     try:
         result = es.get_indexes()
@@ -166,6 +273,7 @@ def get_indexes():
 
 
 @app.route("/reindex", methods=["POST"])
+@admission.admit('write', cost=reindex_cost, fanout=reindex_fanout)
 def reindex():
     """
     Body should look like this:  {'source': 'users', 'dest': 'temp'}
@@ -176,6 +284,7 @@ def reindex():
 
 
 @app.route("/indices/<index_name>", methods=["DELETE"])
+@admission.admit('write', cost=lambda: 1)
 def delete_index(index_name):
     try:
         es.delete_index(str(index_name))
@@ -184,6 +293,12 @@ def delete_index(index_name):
         abort(404)
 
 
+# ------ Admission control ------
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return jsonify(admission.get_metrics())
+
+
 if __name__ == '__main__':
     es.index_documents()
     app.run(port=5000)
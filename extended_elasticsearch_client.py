@@ -216,6 +216,16 @@ class ElasticClient:
     def get_indexes(self):
         return self.es.indices.get_alias()
 
+    def get_liked_counts(self, ids, index, doc_type, field):
+        """
+        Returns lengths of liked lists stored in documents, None for documents that don't exist.
+        """
+        docs = self.es.mget(index=index, doc_type=doc_type, body={"ids": [int(e) for e in ids]})["docs"]
+        return [len(doc["_source"][field]) if doc.get("found") else None for doc in docs]
+
+    def count_documents(self, index):
+        return self.es.count(index=index)["count"]
+
     def reindex(self, old_index, new_index):
         helpers.reindex(self.es, source_index=old_index, target_index=new_index)
 
@@ -0,0 +1,249 @@
+from unittest import mock
+
+import pytest
+from flask import Flask, abort, request
+
+from admission_control import AdmissionController, TokenBucket
+
+
+def make_app(admission, view_calls):
+    app = Flask(__name__)
+
+    @app.route("/read", methods=["GET"])
+    @admission.admit('read')
+    def read():
+        view_calls.append("read")
+        return "Ok", 200
+
+    @app.route("/write/<int:cost>", methods=["POST"])
+    @admission.admit('write', cost=lambda: request.view_args["cost"])
+    def write(cost):
+        view_calls.append("write")
+        return "Ok", 200
+
+    def lookup():
+        view_calls.append("lookup")
+        if request.view_args["fanout"] < 0:
+            abort(404)
+        if request.view_args["fanout"] == 0:
+            raise ConnectionError("Elasticsearch is down")
+        return request.view_args["fanout"]
+
+    @app.route("/stored/<int(signed=True):fanout>", methods=["POST"])
+    @admission.admit('write', fanout=lookup)
+    def stored(fanout):
+        view_calls.append("stored")
+        return "Ok", 200
+
+    @app.route("/malformed", methods=["POST"])
+    @admission.admit('write', cost=lambda: len(request.json["items"]))
+    def malformed():
+        view_calls.append("malformed")
+        return "Ok", 200
+
+    return app
+
+
+@pytest.fixture
+def admission():
+    return AdmissionController(read_concurrency=2, write_concurrency=1, pool_wait=0,
+                               client_budget=100, client_refill_rate=10)
+
+
+@pytest.fixture
+def view_calls():
+    return []
+
+
+@pytest.fixture
+def client(admission, view_calls):
+    return make_app(admission, view_calls).test_client()
+
+
+def test_token_bucket_refills_up_to_capacity():
+    now = 1000
+    bucket = TokenBucket(100, 10, now)
+    assert bucket.try_charge(80, now) == 0
+    assert bucket.try_charge(40, now) == pytest.approx(2)
+    assert bucket.try_charge(40, now + 2) == 0
+    bucket.refill(now + 1000)
+    assert bucket.tokens == 100
+
+
+def test_token_bucket_charges_cost_above_capacity_as_debt():
+    now = 1000
+    bucket = TokenBucket(100, 10, now)
+    assert bucket.try_charge(300, now) == 0
+    assert bucket.tokens == -200
+    assert bucket.wait_time(300, now) == pytest.approx(30)
+
+
+def test_over_budget_gets_429_with_retry_after(client, view_calls):
+    assert client.post("/write/100").status_code == 200
+    response = client.post("/write/50")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "5"
+    assert view_calls == ["write"]
+
+
+def test_request_larger_than_budget_gets_413(client, view_calls):
+    response = client.post("/write/101")
+    assert response.status_code == 413
+    assert response.json["estimatedCost"] == 101
+    assert view_calls == []
+
+
+def test_stored_fanout_is_charged_as_debt(client, admission, view_calls):
+    assert client.post("/stored/1000").status_code == 200
+    response = client.post("/stored/1000")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "91"
+    # Second request is shed on known cost, before looking anything up
+    assert view_calls == ["lookup", "stored"]
+    assert admission.get_metrics()["pools"]["write"]["admitted_cost"] == 1001
+
+
+def test_stored_fanout_over_budget_is_shed(client, admission, view_calls):
+    assert client.post("/write/50").status_code == 200
+    response = client.post("/stored/60")
+    assert response.status_code == 429
+    assert view_calls == ["write", "lookup"]
+    assert admission.get_metrics()["pools"]["write"]["shed_cost"] == 61
+
+
+def test_fanout_lookup_errors(client, view_calls):
+    assert client.post("/stored/-1").status_code == 404
+    response = client.post("/stored/0")
+    assert response.status_code == 503
+    assert response.json["error"] == "Cost estimate unavailable"
+    assert view_calls == ["lookup", "lookup"]
+
+
+def test_malformed_request_is_rejected_before_running(client, admission, view_calls):
+    assert client.post("/malformed", json={"no_items": []}).status_code == 400
+    assert view_calls == []
+    assert admission.get_metrics()["pools"]["write"]["admitted"] == 0
+
+
+def test_full_pool_sheds_without_charging_client(client, admission, view_calls):
+    admission.pools["write"].acquire()
+    try:
+        response = client.post("/write/90")
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "1"
+    finally:
+        admission.pools["write"].release()
+    assert view_calls == []
+    assert admission.buckets == {}
+    assert client.post("/write/90").status_code == 200
+
+
+def test_writes_do_not_use_read_budget(client, view_calls):
+    assert client.post("/write/100").status_code == 200
+    assert client.get("/read").status_code == 200
+    assert view_calls == ["write", "read"]
+
+
+def test_least_recently_used_buckets_are_evicted():
+    admission = AdmissionController(client_budget=100, client_refill_rate=0.001, max_buckets=3)
+    app = Flask(__name__)
+    with app.app_context():
+        for i in range(3):
+            assert admission.charge('write', "10.0.0.{}".format(i), 10) is None
+        assert admission.charge('write', "10.0.0.0", 10) is None
+        assert admission.charge('read', "10.0.0.0", 10) is None
+    assert list(admission.buckets) == [("10.0.0.2", 'write'), ("10.0.0.0", 'write'), ("10.0.0.0", 'read')]
+
+
+def test_metrics_count_admitted_and_shed_load(client, admission):
+    client.get("/read")
+    client.post("/write/60")
+    client.post("/write/60")
+    client.post("/write/200")
+    metrics = admission.get_metrics()
+    assert metrics["buckets"] == 2
+    assert metrics["pools"]["read"]["admitted"] == 1
+    assert metrics["pools"]["write"] == {
+        "admitted": 1,
+        "admitted_cost": 60,
+        "shed_over_budget": 1,
+        "shed_too_large": 1,
+        "shed_pool_full": 0,
+        "shed_cost": 260,
+        "in_flight": 0,
+    }
+
+
+class TestApiCosts:
+    @pytest.fixture
+    def api(self):
+        pytest.importorskip("pandas")
+        pytest.importorskip("elasticsearch")
+        import api
+        # Routes are bound to module controller, so its state is swapped for fresh one
+        with mock.patch.multiple(api.admission, **vars(AdmissionController())), \
+                mock.patch.object(api, "es") as es:
+            es.count_documents.return_value = 2000
+            es.get_liked_counts.side_effect = lambda ids, *args: [3] * len(ids)
+            yield api
+
+    def test_bulk_with_malformed_item_is_rejected(self, api):
+        body = [{"user_id": i, "liked_movies": list(range(10))} for i in range(5)]
+        body.append({"user_id": 999})
+        response = api.app.test_client().post("/user/bulk", json=body)
+        assert response.status_code == 400
+        api.es.bulk_user_update.assert_not_called()
+
+    def test_bulk_with_many_empty_items_is_admitted(self, api):
+        body = [{"movie_id": i, "users_who_liked_movie": []} for i in range(100)]
+        response = api.app.test_client().post("/movie/bulk", json=body)
+        assert response.status_code == 200
+        api.es.bulk_movie_update.assert_called_once()
+
+    def test_document_with_too_many_likes_gets_413(self, api):
+        response = api.app.test_client().put("/movie/document/1", json=list(range(1000)))
+        assert response.status_code == 413
+        api.es.add_movie_document.assert_not_called()
+
+    def test_bulk_is_charged_stored_lists(self, api):
+        body = [{"user_id": i, "liked_movies": [1]} for i in range(5)]
+        response = api.app.test_client().post("/user/bulk", json=body)
+        assert response.status_code == 200
+        api.es.get_liked_counts.assert_called_once_with([0, 1, 2, 3, 4], 'users', 'user', 'ratings')
+        assert api.admission.get_metrics()["pools"]["write"]["admitted_cost"] == 5 * 4 + 2 * 15
+
+    def test_bulk_with_missing_document_gets_404(self, api):
+        api.es.get_liked_counts.side_effect = lambda ids, *args: [3, None]
+        body = [{"user_id": 1, "liked_movies": []}, {"user_id": 2, "liked_movies": []}]
+        response = api.app.test_client().post("/user/bulk", json=body)
+        assert response.status_code == 404
+        api.es.bulk_user_update.assert_not_called()
+
+    def test_delete_is_charged_stored_list(self, api):
+        api.es.get_liked_counts.side_effect = lambda ids, *args: [5000]
+        client = api.app.test_client()
+        assert client.delete("/movie/document/1").status_code == 200
+        api.es.get_liked_counts.assert_called_once_with(['1'], 'movies', 'movie', 'whoRated')
+        assert api.admission.get_metrics()["pools"]["write"]["admitted_cost"] == 10002
+        assert client.delete("/movie/document/2").status_code == 429
+        api.es.delete_movie_document.assert_called_once()
+
+    def test_reindex_of_large_index_is_admitted(self, api):
+        api.es.count_documents.return_value = 10 ** 6
+        response = api.app.test_client().post("/reindex", json={"source": "movies", "dest": "temp"})
+        assert response.status_code == 200
+        assert api.admission.get_metrics()["pools"]["write"]["admitted_cost"] == 4001
+
+    def test_reindex_count_errors(self, api):
+        client = api.app.test_client()
+        api.es.count_documents.side_effect = api.NotFoundError(404, "index_not_found_exception")
+        assert client.post("/reindex", json={"source": "nope", "dest": "temp"}).status_code == 404
+        api.es.count_documents.side_effect = ConnectionError("Elasticsearch is down")
+        assert client.post("/reindex", json={"source": "users", "dest": "temp"}).status_code == 503
+        api.es.reindex.assert_not_called()
+
+    def test_reindex_cost_depends_on_source_size(self, api):
+        response = api.app.test_client().post("/reindex", json={"source": "users", "dest": "temp"})
+        assert response.status_code == 200
+        api.es.count_documents.assert_called_once_with("users")
+        assert api.admission.get_metrics()["pools"]["write"]["admitted_cost"] == 9